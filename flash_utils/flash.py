@@ -4,10 +4,13 @@
 # Imports
 import argparse
 import os
+import queue
 import sys
+import threading
 import time
 import zipfile
-from subprocess import PIPE, Popen
+from concurrent.futures import ThreadPoolExecutor
+from subprocess import Popen
 
 import serial
 from tqdm import tqdm
@@ -17,6 +20,25 @@ BL2_FILE_DEFAULT = "bl2_bp-rzboard.srec"
 FIP_FILE_DEFAULT = "fip-rzboard.srec"
 CORE_IMAGE_FILE_DEFAULT = "avnet-core-image-rzboard.wic"
 
+# U-Boot's command prompt, and seconds to wait for it after each command
+UBOOT_PROMPT = "=> "
+UBOOT_PROMPT_TIMEOUT = 5
+
+# Seconds to wait for U-Boot to be bound to an address by DHCP
+DHCP_TIMEOUT = 60
+
+# Baud rate Flash Writer switches its SCIF to on the SUP command (fixed in its firmware)
+FLASH_WRITER_SUP_BAUD = 921600
+# Seconds to wait for Flash Writer to answer the SUP command, at either baud rate
+FLASH_WRITER_SUP_TIMEOUT = 5
+
+# Size of each block read from an image file and handed to the serial port
+SERIAL_CHUNK_SIZE = 64 * 1024
+# Number of blocks read ahead of the serial port while streaming an image
+SERIAL_READ_AHEAD = 4
+# Seconds a single serial write may block for (a SERIAL_CHUNK_SIZE block takes ~6s at 115200)
+SERIAL_WRITE_TIMEOUT = 30
+
 
 class FlashUtil:
     """
@@ -56,7 +78,15 @@ class FlashUtil:
             self.write_system_image()
         elif self.__args.full:
             self.__setup_serial_port()
-            self.write_bootloader()
+            # Check every image up front, rather than after the bootloader has been flashed
+            if self.rootfs_image is None:
+                die("No rootfsImage argument")
+            check_image_files(self.__bootloader_images() + [("system", self.rootfs_image)])
+            # Extract fastboot while the bootloader is fed over serial
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                adb_extraction = executor.submit(self.__extract_adb)
+                self.write_bootloader()
+                adb_extraction.result()
             self.write_system_image()
         else:
             argparser.error(
@@ -79,6 +109,14 @@ class FlashUtil:
         Handles any path overrides specified via command line arg.
         """
 
+        if self.__args.image_path:
+            print(f"Overwriting default image paths with {self.__args.image_path}.")
+            self.flash_writer_image = f"{self.__args.image_path}/{FLASH_WRITER_FILE_DEFAULT}"
+            self.bl2_image = f"{self.__args.image_path}/{BL2_FILE_DEFAULT}"
+            self.fip_image = f"{self.__args.image_path}/{FIP_FILE_DEFAULT}"
+            self.rootfs_image = f"{self.__args.image_path}/{CORE_IMAGE_FILE_DEFAULT}"
+
+        # Individual image paths take precedence over --image_path
         if self.__args.flash_writer_image_override:
             self.flash_writer_image = self.__args.flash_writer_image_override
         if self.__args.bl2_image_override:
@@ -88,13 +126,6 @@ class FlashUtil:
         if self.__args.rootfs_image_override:
             self.rootfs_image = self.__args.rootfs_image_override
 
-        if self.__args.image_path:
-            print(f"Overwriting default image paths with {self.__args.image_path}.")
-            self.flash_writer_image = f"{self.__args.image_path}/{FLASH_WRITER_FILE_DEFAULT}"
-            self.bl2_image = f"{self.__args.image_path}/{BL2_FILE_DEFAULT}"
-            self.fip_image = f"{self.__args.image_path}/{FIP_FILE_DEFAULT}"
-            self.rootfs_image = f"{self.__args.image_path}/{CORE_IMAGE_FILE_DEFAULT}"
-
     def argparse_and_override_defaults(self):
         """
         Sets up the argument parser before parsing the command line arguments
@@ -156,6 +187,16 @@ class FlashUtil:
             type=int,
             help="Baud rate for serial port (defaults to: 115200).",
         )
+        argparser.add_argument(
+            "--serial_speed_up",
+            default=False,
+            action="store_true",
+            dest="serialSpeedUp",
+            help=(
+                "Switch to Flash Writer's faster baud rate (SUP command,"
+                f" {FLASH_WRITER_SUP_BAUD}) once it is running, speeding up bootloader flashing."
+            ),
+        )
 
         # Images
         argparser.add_argument(
@@ -205,6 +246,16 @@ class FlashUtil:
             action="store",
             help="IP Address assigned to board during flashing.",
         )
+        argparser.add_argument(
+            "--fastboot_usb",
+            default=False,
+            action="store_true",
+            dest="fastbootUSB",
+            help=(
+                "Flash rootfs with fastboot over the board's USB OTG port instead of"
+                " the network (much faster, requires a USB cable to the OTG port)."
+            ),
+        )
 
         # Target
         argparser.add_argument(
@@ -226,8 +277,24 @@ class FlashUtil:
     def __setup_serial_port(self):
         try:
             self.__serial_port = serial.Serial(
-                port=self.__args.serialPort, baudrate=self.__args.baudRate
+                port=self.__args.serialPort,
+                baudrate=self.__args.baudRate,
+                write_timeout=SERIAL_WRITE_TIMEOUT,
             )
+            # Windows drivers default to 4 KiB queues, let a whole image block be queued
+            if sys.platform == "win32":
+                self.__serial_port.set_buffer_size(
+                    rx_size=SERIAL_CHUNK_SIZE, tx_size=SERIAL_CHUNK_SIZE
+                )
+            # USB serial adapters on Linux hold received bytes for up to 16 ms (the FTDI
+            # latency timer), delaying every prompt. Not all drivers support changing it.
+            elif sys.platform == "linux":
+                try:
+                    self.__serial_port.set_low_latency_mode(True)
+                except ValueError:
+                    pass
+            # Bytes read from the serial port but not yet consumed by wait_for_serial_read
+            self.__serial_buffer = bytearray()
         except Exception as e:  # pylint: disable=broad-exception-caught
             die(
                 msg=(
@@ -245,7 +312,7 @@ class FlashUtil:
         # Wait for device to be ready to receive image.
         print("Please power on board. Make sure boot2 is strapped.")
         with tqdm(total=1) as progress_bar:
-            self.__serial_port.read_until("please send !".encode())
+            self.wait_for_serial_read("please send !", print_buffer=self.__args.debug)
             progress_bar.update(1)
 
         print("Flashing bootloader, this will take a few minutes...")
@@ -253,13 +320,45 @@ class FlashUtil:
             self.flash_flash_writer()
             progress_bar.update(1)
 
-            if self.__args.qspi:
-                self.flash_bootloader_qspi(progress_bar)
-            else:
-                self.flash_bootloader_emmc(progress_bar)
+            try:
+                if self.__args.serialSpeedUp:
+                    self.speed_up_serial()
+
+                if self.__args.qspi:
+                    self.flash_bootloader_qspi(progress_bar)
+                else:
+                    self.flash_bootloader_emmc(progress_bar)
+            finally:
+                # Let the image finish going out on the wire before changing rate, then
+                # return to the boot baud rate, U-Boot talks at this rate after reset
+                self.__serial_port.flush()
+                self.__serial_port.baudrate = self.__args.baudRate
 
         print("Done flashing bootloader!")
 
+    def speed_up_serial(self):
+        """
+        Asks Flash Writer to raise its SCIF baud rate (SUP command) and follows it
+        with the host serial port.
+
+        Note
+        ----
+        Flash Writer itself has to be sent at the boot baud rate, so this can only
+        be done once flash_flash_writer has completed.
+        """
+        self.write_serial_cmd("SUP")
+        self.wait_for_serial_read(
+            "terminal.", print_buffer=self.__args.debug, timeout=FLASH_WRITER_SUP_TIMEOUT
+        )
+        self.__serial_port.baudrate = FLASH_WRITER_SUP_BAUD
+
+        # Any prompt printed during the switch is garbled, request a fresh one. If it
+        # never comes, the serial adapter can't keep up with the faster rate.
+        self.write_serial_cmd("")
+        self.wait_for_serial_read(
+            ">", print_buffer=self.__args.debug, timeout=FLASH_WRITER_SUP_TIMEOUT
+        )
+
     def flash_bootloader_emmc(self, progress_bar):
         """Flashes the bootloader to the eMMC memory."""
 
@@ -344,6 +443,7 @@ class FlashUtil:
         self.write_serial_cmd("b3")
         self.wait_for_serial_read(":", print_buffer=self.__args.debug)
         self.write_serial_cmd("8")
+        self.wait_for_serial_read(">", print_buffer=self.__args.debug)
 
     def flash_erase_emmc(self):
         """
@@ -415,35 +515,77 @@ class FlashUtil:
         Die if any of the files are missing.
         """
 
-        if not os.path.isfile(self.flash_writer_image):
-            die(f"Missing flash writer image: {self.flash_writer_image}")
+        check_image_files(self.__bootloader_images())
+
+    def __bootloader_images(self):
+        """Return (name, path) pairs for the bootloader images."""
+
+        return [
+            ("flash writer", self.flash_writer_image),
+            ("bl2", self.bl2_image),
+            ("FIP", self.fip_image),
+        ]
 
-        if not os.path.isfile(self.bl2_image):
-            die(f"Missing bl2 image: {self.bl2_image}")
+    def check_system_image_file(self):
+        """
+        Checks if the system image exists in the specified file path.
+        Die if it is missing.
+        """
+
+        if self.rootfs_image is None:
+            die("No rootfsImage argument")
 
-        if not os.path.isfile(self.fip_image):
-            die(f"Missing FIP image: {self.fip_image}")
+        check_image_files([("system", self.rootfs_image)])
 
     # Function to write system image over fastboot
     def write_system_image(self):
         """Write system image (containing kernel, dtb, and rootfs) to board.)"""
-        # Check for system image
-        if self.rootfs_image is None:
-            die("No rootfsImage argument")
 
-        if not os.path.isfile(self.rootfs_image):
-            die(f"Missing system image: {self.rootfs_image}")
+        self.check_system_image_file()
+
+        # Extract fastboot while the board is powered on and brought into fastboot mode
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            adb_extraction = executor.submit(self.__extract_adb)
+            device_ip_address = self.__enter_fastboot_mode()
+            adb_extraction.result()
 
-        self.__extract_adb()
+        fastboot_path = f"{self.__script_dir}/adb/platform-tools/fastboot"
+        fastboot_args = ["-v", "flash", "rawimg"]
+        # Over USB, fastboot finds the board itself
+        if device_ip_address is not None:
+            fastboot_args = ["-s", f"udp:{device_ip_address}", *fastboot_args]
+        start_time = time.monotonic()
+        # fastboot inherits stdout/stderr, writing its progress straight to the terminal
+        with Popen([fastboot_path, *fastboot_args, self.rootfs_image]) as fastboot_process:
+            fastboot_process.wait()
 
+        if fastboot_process.returncode != 0:
+            die("Failed to flash rootfs.")
+
+        elapsed = time.monotonic() - start_time
+        size_mb = os.path.getsize(self.rootfs_image) / (1024 * 1024)
+        print(
+            f"Flashed {size_mb:.1f} MB rootfs in {elapsed:.1f}s"
+            f" ({size_mb / max(elapsed, 0.001):.2f} MB/s)."
+        )
+
+    # Function to interrupt U-Boot, set up networking and enter fastboot mode,
+    # returning the IP address fastboot is listening on (None over USB)
+    def __enter_fastboot_mode(self):
         print("Power on board. Make sure boot2 strap is NOT on.")
         print("Waiting for device...")
 
         # Interrupt boot sequence
-        self.__serial_port.read_until("Hit any key to stop autoboot:".encode())
+        self.wait_for_serial_read("Hit any key to stop autoboot:", print_buffer=self.__args.debug)
         self.write_serial_cmd("y")
+        self.wait_for_serial_read(
+            UBOOT_PROMPT, print_buffer=self.__args.debug, timeout=UBOOT_PROMPT_TIMEOUT
+        )
 
-        time.sleep(1)
+        if self.__args.fastbootUSB:
+            print("Putting device into fastboot mode over USB")
+            self.write_serial_cmd("\rfastboot usb 0")
+            return None
 
         # Set static ip or attempt to get ip from dhcp
         if self.__args.staticIP:
@@ -452,33 +594,24 @@ class FlashUtil:
         else:
             print("Waiting for device to be assigned IP address...")
             self.write_serial_cmd("\rsetenv autoload no; dhcp")
-            self.__serial_port.read_until("DHCP client bound".encode())
+            self.wait_for_serial_read(
+                "DHCP client bound", print_buffer=self.__args.debug, timeout=DHCP_TIMEOUT
+            )
 
-        time.sleep(1)
+        self.wait_for_serial_read(
+            UBOOT_PROMPT, print_buffer=self.__args.debug, timeout=UBOOT_PROMPT_TIMEOUT
+        )
 
         # Put device into fastboot mode
         print("Putting device into fastboot mode")
         self.write_serial_cmd("\rfastboot udp")
-        self.__serial_port.read_until("Listening for fastboot command on ".encode())
-        print("Device in fastboot mode")
-        self.__device_ip_address = (
-            self.__serial_port.readline().decode().replace("\n", "").replace("\r", "")
+        self.wait_for_serial_read(
+            "Listening for fastboot command on ", print_buffer=self.__args.debug
         )
-
-        fastboot_path = f"{self.__script_dir}/adb/platform-tools/fastboot"
-        fastboot_args = f"-s udp:{self.__device_ip_address} -v flash rawimg {self.rootfs_image}"
-        with Popen(
-            fastboot_path + " " + fastboot_args,
-            shell=True,
-            stdout=PIPE,
-            bufsize=1,
-            universal_newlines=True,
-        ) as fastboot_process:
-            for line in fastboot_process.stdout:
-                print(line, end="")
-
-        if fastboot_process.returncode != 0:
-            die("Failed to flash rootfs.")
+        print("Device in fastboot mode")
+        # The address follows the marker on the same line
+        ip_line = self.wait_for_serial_read(timeout=UBOOT_PROMPT_TIMEOUT)
+        return ip_line.decode(errors="replace").strip()
 
     def write_serial_cmd(self, cmd, prefix=""):
         """
@@ -489,65 +622,244 @@ class FlashUtil:
             prefix (str): What to prepend before the command. Useful for prepending
                 carriage returns.
         """
-        self.__serial_port.write(f"{prefix}{cmd}\r".encode())
+        self.__write_serial(f"{prefix}{cmd}\r".encode())
+
+    # Function to write to serial, giving up if the port stops accepting data
+    def __write_serial(self, data):
+        try:
+            self.__serial_port.write(data)
+        except serial.SerialTimeoutException:
+            # Part of the data may have gone out, so it can't safely be written again
+            die(
+                f"Timed out writing to serial port after {SERIAL_WRITE_TIMEOUT}s.\n"
+                "Is your device still connected?"
+            )
 
     # Function to write file over serial
     def write_file_to_serial(self, file):
         """
         Writes the contents of a file to the serial port.
 
+        Where the platform and port support it, the file is handed to the port with
+        os.sendfile. Otherwise it is written in SERIAL_CHUNK_SIZE blocks, with a
+        background thread reading up to SERIAL_READ_AHEAD blocks ahead so disk reads
+        overlap with the (much slower) serial transfer. Either way, a progress bar
+        shows the bytes sent so far.
+
         Args:
             file (str): The path to the file to be written.
 
         Returns:
             None
         """
-        with open(file, "rb") as transmit_file:
-            self.__serial_port.write(transmit_file.read())
-            transmit_file.close()
+        with open(file, "rb") as transmit_file, tqdm(
+            total=os.path.getsize(file),
+            desc=os.path.basename(file),
+            unit="B",
+            unit_scale=True,
+            leave=False,
+        ) as file_progress:
+            if not self.__sendfile_to_serial(transmit_file, file_progress):
+                self.__write_chunks_to_serial(transmit_file, file_progress)
+
+    # Function to stream an open file to serial in blocks read ahead on a background thread
+    def __write_chunks_to_serial(self, transmit_file, file_progress):
+        chunks = queue.Queue(maxsize=SERIAL_READ_AHEAD)
+        stop = threading.Event()
+        reader = threading.Thread(
+            target=read_file_chunks, args=(transmit_file, chunks, stop), daemon=True
+        )
+        reader.start()
+
+        try:
+            for chunk in iter(chunks.get, None):
+                if isinstance(chunk, OSError):
+                    raise chunk
+                self.__write_serial(chunk)
+                file_progress.update(len(chunk))
+        finally:
+            # Unblock the reader if it is waiting on a full queue, then let it exit
+            stop.set()
+            while reader.is_alive():
+                try:
+                    chunks.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            reader.join()
+
+    def __sendfile_to_serial(self, transmit_file, file_progress):
+        """
+        Sends an open file straight to the serial port's file descriptor with os.sendfile,
+        so its contents are never copied through Python.
+
+        Args:
+            transmit_file (file): The open binary file to send.
+            file_progress (tqdm): Progress bar updated with the bytes sent.
 
-    def wait_for_serial_read(self, cond="\n", print_buffer=False):
+        Returns:
+            bool: False if the platform or port does not support it and nothing was sent.
+        """
+        # Windows COM ports have no file descriptor
+        port_fd = self.__serial_port.fileno() if hasattr(self.__serial_port, "fileno") else None
+        if not hasattr(os, "sendfile") or not isinstance(port_fd, int):
+            return False
+
+        file_fd = transmit_file.fileno()
+        size = os.fstat(file_fd).st_size
+        offset = 0
+        while offset < size:
+            try:
+                # At most a block per call, so progress is updated as the file goes out
+                sent = os.sendfile(port_fd, file_fd, offset, min(size - offset, SERIAL_CHUNK_SIZE))
+            except OSError:
+                # e.g. macOS only supports sendfile to sockets; fall back if nothing went out
+                if offset:
+                    raise
+                return False
+
+            if not sent:
+                break
+            offset += sent
+            file_progress.update(sent)
+
+        return True
+
+    def wait_for_serial_read(self, cond="\n", print_buffer=False, timeout=None):
         """
         Reads data from the serial port until the specified condition is met.
 
+        Data is read in bulk (everything the port has waiting, or a single blocking
+        byte when it has nothing) rather than byte by byte. Anything read past the
+        condition is kept for the next call.
+
         Args:
             cond (str): The condition to wait for before returning the data.
                 Defaults to newline character.
             print_buffer (bool): Whether to print the read data to the console. Defaults to False.
+            timeout (float): Seconds to wait for the condition before dying. Defaults to
+                None (wait forever).
 
         Returns:
-            bytes: The data read from the serial port.
+            bytes: The data read from the serial port, up to and including the condition.
         """
-        buf = self.__serial_port.read_until(cond.encode())
+        marker = cond.encode()
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        end = self.__serial_buffer.find(marker)
+        try:
+            while end == -1:
+                if deadline is not None:
+                    self.__serial_port.timeout = max(deadline - time.monotonic(), 0)
+                try:
+                    data = self.__serial_port.read(self.__serial_port.in_waiting or 1)
+                except serial.SerialException as e:
+                    # e.g. the USB serial adapter was unplugged while waiting
+                    die(f"Lost serial port while waiting for '{cond}'. Error: {e}")
+                if not data:
+                    die(f"Timed out waiting for '{cond}'.")
+
+                # Only search the newly read bytes (and a marker's length before them)
+                start = max(len(self.__serial_buffer) - len(marker) + 1, 0)
+                self.__serial_buffer += data
+                end = self.__serial_buffer.find(marker, start)
+        finally:
+            self.__serial_port.timeout = None
+
+        end += len(marker)
+        buf = bytes(self.__serial_buffer[:end])
+        del self.__serial_buffer[:end]
 
         if print_buffer:
-            print(f"{buf.decode()}")
+            print(buf.decode(errors="replace"))
 
         return buf
 
     # Function to check and extract adb
     def __extract_adb(self):
+        fastboot_name = "fastboot.exe" if sys.platform == "win32" else "fastboot"
+        fastboot_path = f"{self.__script_dir}/adb/platform-tools/{fastboot_name}"
+
+        # Platform tools are kept between runs, only extract them the first time
+        if not os.path.isfile(fastboot_path):
+            with zipfile.ZipFile(self.__adb_archive_path(), "r") as zip_ref:
+                # Only fastboot (and the libraries it loads) is used. It is extracted last,
+                # so its presence means a previous extraction completed.
+                members = [name for name in zip_ref.namelist() if is_fastboot_member(name)]
+                members.sort(key=lambda name: os.path.basename(name).startswith("fastboot"))
+                zip_ref.extractall(f"{self.__script_dir}/adb", members=members)
+
+        # zipfile does not restore permissions. Older versions of this util also set
+        # them to decimal 755, so check already extracted copies too.
+        if sys.platform != "win32" and not os.access(fastboot_path, os.X_OK):
+            os.chmod(fastboot_path, 0o755)
+
+    # Function to find the platform tools archive for this platform
+    def __adb_archive_path(self):
         archive_path = ""
-        # Extract platform tools if not already extracted
-        if not os.path.exists(f"{self.__script_dir}/platform-tools"):
-            if sys.platform == "linux":
-                archive_path = f"{self.__script_dir}/adb/platform-tools-latest-linux.zip"
-            elif sys.platform == "darwin":
-                archive_path = f"{self.__script_dir}/adb/platform-tools-latest-darwin.zip"
-            elif sys.platform == "win32":
-                archive_path = f"{self.__script_dir}/adb/platform-tools-latest-windows.zip"
-            else:
-                die("Unknown platform.")
+        if sys.platform == "linux":
+            archive_path = f"{self.__script_dir}/adb/platform-tools-latest-linux.zip"
+        elif sys.platform == "darwin":
+            archive_path = f"{self.__script_dir}/adb/platform-tools-latest-darwin.zip"
+        elif sys.platform == "win32":
+            archive_path = f"{self.__script_dir}/adb/platform-tools-latest-windows.zip"
+        else:
+            die("Unknown platform.")
 
         if not os.path.isfile(archive_path):
             die("Can't find adb for your system. \
                 This util expects to be ran from the flash_rzboard.py dir.")
 
-        with zipfile.ZipFile(archive_path, "r") as zip_ref:
-            zip_ref.extractall(f"{self.__script_dir}/adb")
+        return archive_path
 
-        if sys.platform != "win32":
-            os.chmod(f"{self.__script_dir}/adb/platform-tools/fastboot", 755)
+
+def check_image_files(images):
+    """
+    Checks that every (name, path) pair in images points at an existing file.
+    Die listing all of the missing images, so they can be fixed in one go.
+    """
+
+    missing = [f"Missing {name} image: {path}" for name, path in images if not os.path.isfile(path)]
+    if missing:
+        die("\n".join(missing))
+
+
+def is_fastboot_member(name):
+    """
+    Checks if a platform-tools archive member is needed to run fastboot.
+
+    Args:
+        name (str): The archive member name.
+
+    Returns:
+        bool: True for fastboot itself and the libraries it loads.
+    """
+    return (
+        os.path.basename(name) in ("fastboot", "fastboot.exe")
+        or name.startswith("platform-tools/lib64/")
+        or name.endswith(".dll")
+    )
+
+
+def read_file_chunks(transmit_file, chunks, stop):
+    """
+    Reads a file in SERIAL_CHUNK_SIZE blocks onto a queue, followed by None once
+    the file is exhausted. A read error is put on the queue in place of None.
+
+    Args:
+        transmit_file (file): The open binary file to read.
+        chunks (queue.Queue): The queue to put the blocks on.
+        stop (threading.Event): Set by the consumer to stop reading early.
+    """
+    try:
+        for chunk in iter(lambda: transmit_file.read(SERIAL_CHUNK_SIZE), b""):
+            if stop.is_set():
+                return
+            chunks.put(chunk)
+    except OSError as e:
+        chunks.put(e)
+        return
+
+    chunks.put(None)
 
 
 def die(msg="", code=1):
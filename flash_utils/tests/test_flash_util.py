@@ -2,21 +2,84 @@
 This module contains unit tests for the FlashUtil class in the flash_utils.flash module.
 """
 
+import io
+import os
 import sys
-from unittest.mock import Mock, call
+import threading
+import tty
+from pathlib import Path
+from unittest.mock import Mock, PropertyMock, call
 
 import pytest
+import serial
 
 from flash_utils.flash import (
     BL2_FILE_DEFAULT,
     CORE_IMAGE_FILE_DEFAULT,
     FIP_FILE_DEFAULT,
     FLASH_WRITER_FILE_DEFAULT,
+    FLASH_WRITER_SUP_BAUD,
+    FLASH_WRITER_SUP_TIMEOUT,
+    SERIAL_CHUNK_SIZE,
+    SERIAL_WRITE_TIMEOUT,
     FlashUtil,
 )
 
 DEFAULT_BAUD_RATE = 115200
 DEFAULT_SERIAL_PORT = "/dev/ttyUSB0"
+DEVICE_IP_ADDRESS = "192.168.1.99"
+
+
+class SerialDevice:
+    """
+    Scripted stand-in for the board on the other end of the serial port.
+
+    The script is a list of (expected write, response) steps. Each write must continue
+    the next step, and (unless burst is set) must only start once everything the device
+    sent so far has been read. The step's response is made readable once its write is
+    complete. Writes made
+    after the script is exhausted are accepted without a response.
+    """
+
+    def __init__(self):
+        self.output = bytearray()
+        self.script = []
+        self.received = b""
+        # Most bytes reported by in_waiting at once, to split output across reads
+        self.burst = None
+
+    def load(self, script, output=b""):
+        """Sets the steps to play, and any output already sent (e.g. at power on)."""
+        self.script = list(script)
+        self.output += output
+
+    def in_waiting(self):
+        """Number of bytes waiting to be read."""
+        return len(self.output) if self.burst is None else min(len(self.output), self.burst)
+
+    def read(self, size=1):
+        """Reads up to size bytes, returning b"" (a timeout) when there are none."""
+        data = bytes(self.output[:size])
+        del self.output[:size]
+        return data
+
+    def write(self, data):
+        """Receives data written by FlashUtil."""
+        data = bytes(data)
+        if not self.script:
+            return len(data)
+
+        expected, response = self.script[0]
+        if not self.received and self.burst is None:
+            assert not self.output, f"{data!r} written before {bytes(self.output)!r} was read"
+        self.received += data
+        assert expected.startswith(self.received), f"wrote {data!r}, expected {expected!r}"
+
+        if self.received == expected:
+            self.script.pop(0)
+            self.received = b""
+            self.output += response
+        return len(data)
 
 
 @pytest.fixture(name="mock_serial_port")
@@ -24,10 +87,113 @@ def fixture_serial_port(monkeypatch):
     """Mock the serial port for testing. Useful for testing on github actions."""
 
     serial_mock = Mock()
+    serial_mock.device = SerialDevice()
+    port = serial_mock.return_value
+    port.read.side_effect = serial_mock.device.read
+    port.write.side_effect = serial_mock.device.write
+    type(port).in_waiting = PropertyMock(side_effect=serial_mock.device.in_waiting)
     monkeypatch.setattr("flash_utils.flash.serial.Serial", serial_mock)
     return serial_mock
 
 
+def file_write_to(device):
+    """Mock for FlashUtil.write_file_to_serial that sends the file straight to device."""
+
+    return Mock(side_effect=lambda file: device.write(Path(file).read_bytes()))
+
+
+def emmc_bootloader_script(flash_writer_image, bl2_image, fip_image):
+    """Flash Writer exchange for writing the bootloader to eMMC."""
+
+    return [
+        (flash_writer_image.read_bytes(), b"Flash writer for RZ/V2L\r\n>"),
+        (b"EM_E\r", b"\r\n  Select area(0-2)>"),
+        (b"1\r", b"\r\n  EM_E Complete!\r\n>"),
+        (b"EM_SECSD\r", b"\r\n  Please Input EXT_CSD Index(H'00 - H'1FF) :"),
+        (b"b1\r", b"\r\n  Please Input Value(H'00 - H'FF) :"),
+        (b"2\r", b"\r\n>"),
+        (b"EM_SECSD\r", b"\r\n  Please Input EXT_CSD Index(H'00 - H'1FF) :"),
+        (b"b3\r", b"\r\n  Please Input Value(H'00 - H'FF) :"),
+        (b"8\r", b"\r\n>"),
+        (b"EM_W\r", b"\r\n  Select area(0-2)>"),
+        (b"1\r", b"\r\n  Please Input Start Address in sector :"),
+        (b"1\r", b"\r\n  Please Input Program Start Address :"),
+        (b"11E00\r", b"\r\n  please send ! ('.' & CR stop load)"),
+        (bl2_image.read_bytes(), b"\r\n  EM_W Complete!\r\n>"),
+        (b"EM_W\r", b"\r\n  Select area(0-2)>"),
+        (b"1\r", b"\r\n  Please Input Start Address in sector :"),
+        (b"100\r", b"\r\n  Please Input Program Start Address :"),
+        (b"00000\r", b"\r\n  please send ! ('.' & CR stop load)"),
+        (fip_image.read_bytes(), b"\r\n  EM_W Complete!\r\n>"),
+    ]
+
+
+def qspi_bootloader_script(flash_writer_image, bl2_image, fip_image):
+    """Flash Writer exchange for writing the bootloader to QSPI."""
+
+    return [
+        (flash_writer_image.read_bytes(), b"Flash writer for RZ/V2L\r\n>"),
+        (b"\rXCS\r", b"\r\n  ALL ERASE SpiFlash memory\r\n  Clear OK?(y/n)"),
+        (b"y\r", b"\r\n  Erase Completed\r\n>"),
+        (b"XLS2\r", b"\r\n  Please Input : H'"),
+        (b"11E00\r", b"\r\n  Please Input : H'"),
+        (b"00000\r", b"\r\n  please send ! ('.' & CR stop load)"),
+        (bl2_image.read_bytes(), b""),
+        (b"XLS2\r", b"\r\n  Please Input : H'"),
+        (b"00000\r", b"\r\n  Please Input : H'"),
+        (b"1D200\r", b"\r\n  please send ! ('.' & CR stop load)"),
+        (fip_image.read_bytes(), b""),
+    ]
+
+
+def speed_up_script():
+    """Flash Writer exchange for the SUP command."""
+
+    return [
+        (
+            b"SUP\r",
+            b"\r\n  Scif speed UP\r\n"
+            b"  Please change to 921.6Kbps baud rate setting of the terminal.",
+        ),
+        (b"\r", b"\r\n>"),
+    ]
+
+
+def rootfs_script():
+    """U-Boot exchange for putting the board into fastboot mode over DHCP."""
+
+    return [
+        (b"y\r", b"\r\n=> "),
+        (
+            b"\rsetenv autoload no; dhcp\r",
+            b"\r\nBOOTP broadcast 1\r\nDHCP client bound to address "
+            + DEVICE_IP_ADDRESS.encode()
+            + b" (3 ms)\r\n=> ",
+        ),
+        (
+            b"\rfastboot udp\r",
+            b"\r\nListening for fastboot command on " + DEVICE_IP_ADDRESS.encode() + b"\r\n",
+        ),
+    ]
+
+
+AUTOBOOT_PROMPT = b"U-Boot 2021.10\r\nHit any key to stop autoboot:"
+
+
+@pytest.fixture(name="no_sleep", autouse=True)
+def fixture_no_sleep(monkeypatch):
+    """Make sure no test waits on a real time.sleep"""
+
+    monkeypatch.setattr("flash_utils.flash.time.sleep", lambda *_: None)
+
+
+@pytest.fixture(name="restore_argv", autouse=True)
+def fixture_restore_argv(monkeypatch):
+    """Restore sys.argv after each test, which sets it for FlashUtil to parse"""
+
+    monkeypatch.setattr(sys, "argv", ["flash_util.py"])
+
+
 @pytest.fixture(name="mock_popen")
 def fixture_popen(monkeypatch):
     """Mock the subprocess.Popen call for testing"""
@@ -36,16 +202,19 @@ def fixture_popen(monkeypatch):
     class ContextBundle:
         """Mock the subprocess.Popen context manager return value"""
 
-        def __init__(self, code, stdout):
+        def __init__(self, code):
             self.returncode = code
-            self.stdout = stdout
+
+        def wait(self):
+            """Mock waiting for the process to exit"""
+            return self.returncode
 
     class MockPopen(Mock):
         """Mock the subprocess.Popen call."""
 
         def __init__(self, *args, **kwargs):
             super().__init__(*args, **kwargs)
-            self.context = ContextBundle(code=0, stdout=[])
+            self.context = ContextBundle(code=0)
 
         def __enter__(self):
             return self.context
@@ -66,12 +235,9 @@ def test_flash_util_help(capsys: pytest.CaptureFixture[str], option):
         # --help will cause SystemExit 0
         sys.argv = ["flash_util.py", option]
         FlashUtil()
-
-        assert excinfo.value == 0
+    assert excinfo.value.code == 0
 
     output = capsys.readouterr()
-    assert output is not None
-
     assert "--help" in output.out
     assert "--bootloader" in output.out
     assert "--rootfs" in output.out
@@ -88,7 +254,6 @@ def test_bad_bootloader_param(capsys: pytest.CaptureFixture[str], flash_options)
         FlashUtil()
     output = capsys.readouterr()
 
-    assert output is not None
     assert "unrecognized arguments" in output.err
 
 
@@ -102,11 +267,39 @@ def test_good_params_missing_images(
         # SystemExit expected for missing flash file
         sys.argv = ["flash_util.py", flash_option]
         FlashUtil()
+    err = capsys.readouterr().err.lower()
+    mock_serial_port.assert_called_once_with(
+        port=DEFAULT_SERIAL_PORT, baudrate=DEFAULT_BAUD_RATE, write_timeout=SERIAL_WRITE_TIMEOUT
+    )
+
+    assert "missing" in err and "image" in err
+
+
+@pytest.mark.usefixtures("mock_serial_port")
+def test_missing_images_reported_together(capsys: pytest.CaptureFixture[str], tmp_path):
+    """Test every missing image is listed in one error, not just the first"""
+
+    with pytest.raises(SystemExit):
+        sys.argv = ["flash_util.py", "--full", "--image_path", str(tmp_path)]
+        FlashUtil()
+    output = capsys.readouterr().err.lower()
+
+    for name in ("flash writer", "bl2", "fip", "system"):
+        assert f"missing {name} image" in output
+
+
+def test_full_missing_rootfs_image(capsys: pytest.CaptureFixture[str], tmp_path, mock_serial_port):
+    """Test --full checks the rootfs image exists before flashing the bootloader"""
+
+    image_dir, _, _, _ = setup_tmp_bootloader_dir_and_files(tmp_path)
+
+    with pytest.raises(SystemExit):
+        sys.argv = ["flash_util.py", "--full", "--image_path", str(image_dir)]
+        FlashUtil()
     output = capsys.readouterr()
-    mock_serial_port.assert_called_once_with(port=DEFAULT_SERIAL_PORT, baudrate=DEFAULT_BAUD_RATE)
 
-    assert output is not None
-    assert "missing" in output.err.lower() and "image" in output.err.lower()
+    assert "missing system image" in output.err.lower()
+    mock_serial_port.return_value.write.assert_not_called()
 
 
 def setup_tmp_rootfs_dir_and_file(tmp_path):
@@ -120,24 +313,21 @@ def setup_tmp_rootfs_dir_and_file(tmp_path):
         A tuple containing the path to the image directory and the path to the rootfs file.
     """
 
-    rootfs_content = "TEMP ROOTFS FILE DATA"
+    rootfs_content = b"TEMP ROOTFS FILE DATA"
 
     image_dir = tmp_path / "images"
     image_dir.mkdir()
     rootfs_file = image_dir / CORE_IMAGE_FILE_DEFAULT
-    rootfs_file.write_text(rootfs_content)
+    rootfs_file.write_bytes(rootfs_content)
     return image_dir, rootfs_file
 
 
-def test_rootfs_write(
-    capsys: pytest.CaptureFixture[str], tmp_path, mock_serial_port, mock_popen, monkeypatch
-):
+def test_rootfs_write(capsys: pytest.CaptureFixture[str], tmp_path, mock_serial_port, mock_popen):
     """Test FlashUtil writing rootfs with temp path"""
 
     image_dir, _ = setup_tmp_rootfs_dir_and_file(tmp_path)
 
-    # mock sleep to reduce test time
-    monkeypatch.setattr("flash_utils.flash.time.sleep", Mock())
+    mock_serial_port.device.load(rootfs_script(), output=AUTOBOOT_PROMPT)
 
     # normal users probably dont pass image_path, but we are generating a temp path
     sys.argv = ["flash_util.py", "--rootfs", "--image_path", str(image_dir)]
@@ -145,23 +335,30 @@ def test_rootfs_write(
 
     output = capsys.readouterr()
     assert "Power on board. Make sure boot2 strap is NOT on." in output.out
+    assert "MB/s" in output.out
 
-    mock_serial_port.assert_called_once_with(port=DEFAULT_SERIAL_PORT, baudrate=DEFAULT_BAUD_RATE)
+    mock_serial_port.assert_called_once_with(
+        port=DEFAULT_SERIAL_PORT, baudrate=DEFAULT_BAUD_RATE, write_timeout=SERIAL_WRITE_TIMEOUT
+    )
     mock_popen.assert_called_once()
+    # no shell, and fastboot's output is not piped through python
+    assert not mock_popen.call_args.kwargs
+    assert mock_popen.call_args.args[0][-1] == str(image_dir / CORE_IMAGE_FILE_DEFAULT)
 
     # assert fastboot setup (specific to rootfs flashing)
-    mock_serial_port.return_value.write.assert_any_call("\rfastboot udp\r".encode())
+    mock_serial_port.return_value.write.assert_any_call(b"\rfastboot udp\r")
+    assert not mock_serial_port.device.script
+    assert f"udp:{DEVICE_IP_ADDRESS}" in mock_popen.call_args.args[0]
 
 
 def test_image_rootfs_write(
-    capsys: pytest.CaptureFixture[str], tmp_path, mock_serial_port, mock_popen, monkeypatch
+    capsys: pytest.CaptureFixture[str], tmp_path, mock_serial_port, mock_popen
 ):
     """Test FlashUtil writing rootfs with --image_rootfs <PATH>"""
 
     _, rootfs_file = setup_tmp_rootfs_dir_and_file(tmp_path)
 
-    # mock sleep to reduce test time
-    monkeypatch.setattr("flash_utils.flash.time.sleep", Mock())
+    mock_serial_port.device.load(rootfs_script(), output=AUTOBOOT_PROMPT)
 
     # normal users probably dont pass image_path, but we are generating a temp path
     sys.argv = ["flash_util.py", "--image_rootfs", str(rootfs_file)]
@@ -170,11 +367,31 @@ def test_image_rootfs_write(
     output = capsys.readouterr()
     assert "Power on board. Make sure boot2 strap is NOT on." in output.out
 
-    mock_serial_port.assert_called_once_with(port=DEFAULT_SERIAL_PORT, baudrate=DEFAULT_BAUD_RATE)
+    mock_serial_port.assert_called_once_with(
+        port=DEFAULT_SERIAL_PORT, baudrate=DEFAULT_BAUD_RATE, write_timeout=SERIAL_WRITE_TIMEOUT
+    )
     mock_popen.assert_called_once()
 
     # assert fastboot setup (specific to rootfs flashing)
-    mock_serial_port.return_value.write.assert_any_call("\rfastboot udp\r".encode())
+    mock_serial_port.return_value.write.assert_any_call(b"\rfastboot udp\r")
+    assert not mock_serial_port.device.script
+    assert f"udp:{DEVICE_IP_ADDRESS}" in mock_popen.call_args.args[0]
+
+
+def test_image_rootfs_overrides_image_path(tmp_path, mock_serial_port, mock_popen):
+    """Test --image_rootfs takes precedence over the rootfs in --image_path"""
+
+    image_dir, _ = setup_tmp_rootfs_dir_and_file(tmp_path)
+    rootfs_file = tmp_path / "other.wic"
+    rootfs_file.write_bytes(b"OTHER ROOTFS FILE DATA")
+
+    mock_serial_port.device.load(rootfs_script(), output=AUTOBOOT_PROMPT)
+
+    sys.argv = ["flash_util.py", "--rootfs", "--image_path", str(image_dir)]
+    sys.argv += ["--image_rootfs", str(rootfs_file)]
+    FlashUtil()
+
+    assert mock_popen.call_args.args[0][-1] == str(rootfs_file)
 
 
 def setup_tmp_bootloader_dir_and_files(tmp_path):
@@ -182,9 +399,9 @@ def setup_tmp_bootloader_dir_and_files(tmp_path):
     Creates temporary bootloader directory and files for testing
     """
 
-    flash_writer_content = "TEMP FLASH WRITER FILE DATA"
-    bl2_content = "TEMP BL2 FILE DATA"
-    fip_content = "TEMP FIP IMAGE DATA"
+    flash_writer_content = b"TEMP FLASH WRITER FILE DATA"
+    bl2_content = b"TEMP BL2 FILE DATA"
+    fip_content = b"TEMP FIP IMAGE DATA"
 
     print(f"tmp_path type {type(tmp_path)}")
 
@@ -192,32 +409,40 @@ def setup_tmp_bootloader_dir_and_files(tmp_path):
     image_dir.mkdir()
 
     flash_writer_image = image_dir / FLASH_WRITER_FILE_DEFAULT
-    flash_writer_image.write_text(flash_writer_content)
+    flash_writer_image.write_bytes(flash_writer_content)
     bl2_image = image_dir / BL2_FILE_DEFAULT
-    bl2_image.write_text(bl2_content)
+    bl2_image.write_bytes(bl2_content)
     fip_image = image_dir / FIP_FILE_DEFAULT
-    fip_image.write_text(fip_content)
+    fip_image.write_bytes(fip_content)
 
     return image_dir, flash_writer_image, bl2_image, fip_image
 
 
-def test_flashing_emmc_bootloader(
-    capsys: pytest.CaptureFixture[str], tmp_path, mock_serial_port, monkeypatch
+@pytest.mark.parametrize("target", ([], ["--qspi"]))
+def test_flashing_bootloader(
+    capsys: pytest.CaptureFixture[str], tmp_path, mock_serial_port, monkeypatch, target
 ):
-    """Test FlashUtil writing bootloader to emmc with images from temp path"""
+    """Test FlashUtil writing bootloader to eMMC or QSPI with images from temp path"""
 
     image_dir, flash_writer_image, bl2_image, fip_image = setup_tmp_bootloader_dir_and_files(
         tmp_path
     )
-
-    mock_file_write = Mock()
+    if not target:
+        script = emmc_bootloader_script
+        expected_writes = [b"EM_E\r", b"EM_SECSD\r", b"EM_W\r"]
+    else:
+        # QSPI is cleared, then written to
+        script = qspi_bootloader_script
+        expected_writes = [b"\rXCS\r", b"XLS2\r"]
+
+    mock_serial_port.device.load(
+        script(flash_writer_image, bl2_image, fip_image), output=b"please send !"
+    )
+    mock_file_write = file_write_to(mock_serial_port.device)
     monkeypatch.setattr("flash_utils.flash.FlashUtil.write_file_to_serial", mock_file_write)
 
-    # mock sleep to reduce test time
-    monkeypatch.setattr("flash_utils.flash.time.sleep", Mock())
-
     # normal users probably dont pass image_path, but we are generating a temp path
-    sys.argv = ["flash_util.py", "--bootloader", "--image_path", str(image_dir)]
+    sys.argv = ["flash_util.py", "--bootloader", *target, "--image_path", str(image_dir)]
     FlashUtil()
 
     output = capsys.readouterr()
@@ -227,52 +452,454 @@ def test_flashing_emmc_bootloader(
     # tqdm progress bar prints to stderr by default
     assert "100%" in output.err
 
-    mock_serial_port.assert_called_once_with(port=DEFAULT_SERIAL_PORT, baudrate=DEFAULT_BAUD_RATE)
-    mock_serial_port.return_value.write.assert_any_call("EM_E\r".encode())
-    mock_serial_port.return_value.write.assert_any_call("EM_SECSD\r".encode())
-    mock_serial_port.return_value.write.assert_any_call("EM_W\r".encode())
-    mock_serial_port.return_value.read_until.assert_any_call(">".encode())
+    mock_serial_port.assert_called_once_with(
+        port=DEFAULT_SERIAL_PORT, baudrate=DEFAULT_BAUD_RATE, write_timeout=SERIAL_WRITE_TIMEOUT
+    )
+    for data in expected_writes:
+        mock_serial_port.return_value.write.assert_any_call(data)
+    # every command was sent, in order, after the prompt before it had been read
+    assert not mock_serial_port.device.script
 
     mock_file_write.assert_has_calls(
         [call(str(flash_writer_image)), call(str(bl2_image)), call(str(fip_image))]
     )
 
 
-def test_flashing_qspi_bootloader(
-    capsys: pytest.CaptureFixture[str], tmp_path, mock_serial_port, monkeypatch
+def test_full_extracts_adb_during_bootloader(tmp_path, mock_serial_port, mock_popen, monkeypatch):
+    """Test --full extracts fastboot while the bootloader is being written"""
+
+    image_dir, flash_writer_image, bl2_image, fip_image = setup_tmp_bootloader_dir_and_files(
+        tmp_path
+    )
+    (image_dir / CORE_IMAGE_FILE_DEFAULT).write_bytes(b"TEMP ROOTFS FILE DATA")
+
+    # the board reboots into U-Boot once the bootloader is written
+    script = emmc_bootloader_script(flash_writer_image, bl2_image, fip_image)
+    script[-1] = (script[-1][0], script[-1][1] + AUTOBOOT_PROMPT)
+    mock_serial_port.device.load(script + rootfs_script(), output=b"please send !")
+
+    bootloader_started = threading.Event()
+    overlapped = []
+
+    def write_file(file):
+        bootloader_started.set()
+        mock_serial_port.device.write(Path(file).read_bytes())
+
+    def extract_adb(_flash_util):
+        overlapped.append(bootloader_started.wait(timeout=5))
+
+    monkeypatch.setattr(
+        "flash_utils.flash.FlashUtil.write_file_to_serial", Mock(side_effect=write_file)
+    )
+    monkeypatch.setattr("flash_utils.flash.FlashUtil._FlashUtil__extract_adb", extract_adb)
+
+    sys.argv = ["flash_util.py", "--full", "--image_path", str(image_dir)]
+    FlashUtil()
+
+    assert overlapped and all(overlapped)
+    assert not mock_serial_port.device.script
+    mock_popen.assert_called_once()
+
+
+def test_write_file_to_serial_chunks(
+    capsys: pytest.CaptureFixture[str], tmp_path, mock_serial_port
 ):
-    """Test FlashUtil writing bootloader to qspi with images from temp path"""
+    """Test images larger than SERIAL_CHUNK_SIZE are streamed to serial in blocks"""
 
     image_dir, flash_writer_image, bl2_image, fip_image = setup_tmp_bootloader_dir_and_files(
         tmp_path
     )
+    fip_content = bytes(range(256)) * (SERIAL_CHUNK_SIZE // 128) + b"TAIL"
+    fip_image.write_bytes(fip_content)
+    mock_serial_port.device.load(
+        emmc_bootloader_script(flash_writer_image, bl2_image, fip_image), output=b"please send !"
+    )
 
-    mock_file_write = Mock()
+    sys.argv = ["flash_util.py", "--bootloader", "--image_path", str(image_dir)]
+    FlashUtil()
+
+    writes = [args[0] for args, _ in mock_serial_port.return_value.write.call_args_list]
+
+    assert max(len(data) for data in writes) <= SERIAL_CHUNK_SIZE
+    assert fip_content in b"".join(writes)
+    assert not mock_serial_port.device.script
+    # each image's transfer has its own progress bar, counting bytes
+    err = capsys.readouterr().err
+    assert f"{FIP_FILE_DEFAULT}:" in err
+    assert f"/{round(len(fip_content) / 1000)}k" in err
+
+
+@pytest.mark.parametrize("target", ([], ["--qspi"]))
+def test_flashing_bootloader_serial_speed_up(tmp_path, mock_serial_port, monkeypatch, target):
+    """Test FlashUtil raising the baud rate after loading Flash Writer, then restoring it"""
+
+    image_dir, *images = setup_tmp_bootloader_dir_and_files(tmp_path)
+    script = emmc_bootloader_script if not target else qspi_bootloader_script
+    steps = script(*images)
+    mock_serial_port.device.load(steps[:1] + speed_up_script() + steps[1:], output=b"please send !")
+
+    mock_file_write = file_write_to(mock_serial_port.device)
     monkeypatch.setattr("flash_utils.flash.FlashUtil.write_file_to_serial", mock_file_write)
 
-    # mock sleep to reduce test time
-    monkeypatch.setattr("flash_utils.flash.time.sleep", Mock())
+    port = mock_serial_port.return_value
+    # record any output from the device still unread each time the baud rate is set
+    unread_at_baud_change = []
+    baudrate = PropertyMock(
+        side_effect=lambda *_: unread_at_baud_change.append(bytes(mock_serial_port.device.output))
+    )
+    type(port).baudrate = baudrate
+    calls = Mock()
+    calls.attach_mock(port.write, "write")
+    calls.attach_mock(port.flush, "flush")
+    calls.attach_mock(baudrate, "baudrate")
+    calls.attach_mock(mock_file_write, "write_file")
+
+    sys.argv = ["flash_util.py", "--bootloader", "--serial_speed_up", *target]
+    sys.argv += ["--image_path", str(image_dir)]
+    FlashUtil()
+
+    expected = [
+        call.write(b"SUP\r"),
+        call.baudrate(FLASH_WRITER_SUP_BAUD),
+        call.flush(),
+        call.baudrate(DEFAULT_BAUD_RATE),
+    ]
+    recorded = [c for c in calls.mock_calls if c in expected]
+    assert recorded == expected
+    assert not mock_serial_port.device.script
+    # the rate is only raised once Flash Writer's "change ... terminal." notice has been read
+    assert unread_at_baud_change == [b"", b""]
+    # the raised rate is only dropped once the last image has been drained to the wire
+    assert calls.mock_calls.index(call.flush()) > max(
+        i for i, c in enumerate(calls.mock_calls) if c[0] in ("write", "write_file")
+    )
 
-    # normal users probably dont pass image_path, but we are generating a temp path
-    sys.argv = ["flash_util.py", "--bootloader", "--qspi", "--image_path", str(image_dir)]
+
+def test_serial_speed_up_no_prompt(capsys: pytest.CaptureFixture[str], tmp_path, mock_serial_port):
+    """Test a prompt that never arrives at the faster rate ends the flash instead of hanging"""
+
+    image_dir, *images = setup_tmp_bootloader_dir_and_files(tmp_path)
+    notice = speed_up_script()[0]
+    steps = emmc_bootloader_script(*images)[:1] + [notice, (b"\r", b"")]
+    mock_serial_port.device.load(steps, output=b"please send !")
+
+    port_timeout = PropertyMock()
+    type(mock_serial_port.return_value).timeout = port_timeout
+
+    sys.argv = ["flash_util.py", "--bootloader", "--serial_speed_up"]
+    sys.argv += ["--image_path", str(image_dir)]
+    with pytest.raises(SystemExit):
+        FlashUtil()
+
+    assert "timed out waiting for '>'" in capsys.readouterr().err.lower()
+    timeouts = [c.args[0] for c in port_timeout.call_args_list if c.args and c.args[0]]
+    assert timeouts and all(0 < t <= FLASH_WRITER_SUP_TIMEOUT for t in timeouts)
+    assert mock_serial_port.return_value.baudrate == DEFAULT_BAUD_RATE
+
+
+def test_debug_output_with_undecodable_bytes(
+    capsys: pytest.CaptureFixture[str], tmp_path, mock_serial_port, monkeypatch
+):
+    """Test --debug printing survives boot ROM noise that is not valid UTF-8"""
+
+    image_dir, flash_writer_image, bl2_image, fip_image = setup_tmp_bootloader_dir_and_files(
+        tmp_path
+    )
+    mock_serial_port.device.load(
+        emmc_bootloader_script(flash_writer_image, bl2_image, fip_image),
+        output=b"\xff\xfeplease send !",
+    )
+    monkeypatch.setattr(
+        "flash_utils.flash.FlashUtil.write_file_to_serial", file_write_to(mock_serial_port.device)
+    )
+
+    sys.argv = ["flash_util.py", "--bootloader", "--debug", "--image_path", str(image_dir)]
     FlashUtil()
 
     output = capsys.readouterr()
+    assert "please send !" in output.out
 
-    assert "missing" not in output.err.lower()
-    assert "Please power on board. Make sure boot2 is strapped.".lower() in output.out.lower()
-    # tqdm progress bar prints to stderr by default
-    assert "100%" in output.err
 
-    mock_serial_port.assert_called_once_with(port=DEFAULT_SERIAL_PORT, baudrate=DEFAULT_BAUD_RATE)
+def test_write_file_to_serial_read_error(tmp_path, mock_serial_port, monkeypatch):
+    """Test a failing image read aborts the transfer instead of sending a truncated image"""
 
-    # assert QSPI cleared
-    mock_serial_port.return_value.write.assert_any_call("\rXCS\r".encode())
+    image_dir, _, _, _ = setup_tmp_bootloader_dir_and_files(tmp_path)
 
-    # assert QSPI Being written to
-    mock_serial_port.return_value.write.assert_any_call("XLS2\r".encode())
-    mock_serial_port.return_value.read_until.assert_any_call(">".encode())
+    class FailingFile(io.BytesIO):
+        """Image file whose reads fail"""
 
-    mock_file_write.assert_has_calls(
-        [call(str(flash_writer_image)), call(str(bl2_image)), call(str(fip_image))]
+        def read(self, *_):
+            raise OSError("read failed")
+
+    monkeypatch.setattr("flash_utils.flash.open", lambda *_: FailingFile(), raising=False)
+    mock_serial_port.device.load([], output=b"please send !")
+
+    sys.argv = ["flash_util.py", "--bootloader", "--image_path", str(image_dir)]
+    with pytest.raises(OSError, match="read failed"):
+        FlashUtil()
+
+    mock_serial_port.return_value.write.assert_not_called()
+
+
+def test_write_file_to_serial_write_error(tmp_path, mock_serial_port):
+    """Test a failing serial write stops the background reader thread"""
+
+    image_dir, flash_writer_image, _, _ = setup_tmp_bootloader_dir_and_files(tmp_path)
+    flash_writer_image.write_bytes(bytes(SERIAL_CHUNK_SIZE * 8))
+    mock_serial_port.device.load([], output=b"please send !")
+    mock_serial_port.return_value.write.side_effect = OSError("write failed")
+
+    threads_before = threading.active_count()
+
+    sys.argv = ["flash_util.py", "--bootloader", "--image_path", str(image_dir)]
+    with pytest.raises(OSError, match="write failed"):
+        FlashUtil()
+
+    assert threading.active_count() == threads_before
+
+
+def test_rootfs_dhcp_timeout(
+    capsys: pytest.CaptureFixture[str], tmp_path, mock_serial_port, mock_popen
+):
+    """Test FlashUtil gives up on the DHCP wait instead of blocking forever"""
+
+    image_dir, _ = setup_tmp_rootfs_dir_and_file(tmp_path)
+
+    # the board never gets an address, so the DHCP wait times out
+    steps = rootfs_script()
+    steps[1] = (steps[1][0], b"\r\nBOOTP broadcast 1\r\nBOOTP broadcast 2\r\n")
+    mock_serial_port.device.load(steps, output=AUTOBOOT_PROMPT)
+
+    sys.argv = ["flash_util.py", "--rootfs", "--image_path", str(image_dir)]
+    with pytest.raises(SystemExit):
+        FlashUtil()
+
+    output = capsys.readouterr()
+    assert "timed out" in output.err.lower()
+    mock_popen.assert_not_called()
+
+
+def test_wait_for_serial_read_bulk_reads(tmp_path, mock_serial_port, mock_popen):
+    """Test prompts split across several reads are found, and data after them is kept"""
+
+    image_dir, _ = setup_tmp_rootfs_dir_and_file(tmp_path)
+
+    # the device only ever has a few bytes waiting at a time
+    mock_serial_port.device.burst = 5
+    mock_serial_port.device.load(rootfs_script(), output=AUTOBOOT_PROMPT)
+
+    sys.argv = ["flash_util.py", "--rootfs", "--image_path", str(image_dir)]
+    flash_util = FlashUtil()
+
+    assert not mock_serial_port.device.script
+    assert f"udp:{DEVICE_IP_ADDRESS}" in mock_popen.call_args.args[0]
+    mock_serial_port.return_value.read.assert_any_call(5)
+
+    # output arriving together is handed out one prompt at a time
+    mock_serial_port.device.burst = None
+    mock_serial_port.device.output += b"first>second>third"
+    assert flash_util.wait_for_serial_read(">") == b"first>"
+    assert flash_util.wait_for_serial_read(">") == b"second>"
+    assert bytes(mock_serial_port.device.output) == b""
+    mock_serial_port.device.output += b">"
+    assert flash_util.wait_for_serial_read(">") == b"third>"
+
+
+@pytest.mark.skipif(not hasattr(os, "sendfile"), reason="os.sendfile not available")
+def test_write_file_to_serial_sendfile(tmp_path, mock_serial_port):
+    """Test images are sent with os.sendfile when the port has a file descriptor"""
+
+    image_dir, flash_writer_image, _, _ = setup_tmp_bootloader_dir_and_files(tmp_path)
+    mock_serial_port.device.load([], output=b"please send !")
+
+    # stand in for the serial port's tty with a raw pseudo terminal
+    board_fd, port_fd = os.openpty()
+    tty.setraw(port_fd)
+    mock_serial_port.return_value.fileno.return_value = port_fd
+
+    try:
+        sys.argv = ["flash_util.py", "--bootloader", "--image_path", str(image_dir)]
+        with pytest.raises(SystemExit):
+            # nothing answers Flash Writer's prompt once it has been sent
+            FlashUtil()
+
+        assert os.read(board_fd, 1024) == flash_writer_image.read_bytes()
+    finally:
+        os.close(board_fd)
+        os.close(port_fd)
+
+    # the image never went through the port's write()
+    mock_serial_port.return_value.write.assert_not_called()
+
+
+@pytest.mark.usefixtures("mock_popen")
+def test_extract_adb_once(tmp_path, mock_serial_port, monkeypatch):
+    """Test platform tools are only extracted when fastboot is not already there"""
+
+    image_dir, _ = setup_tmp_rootfs_dir_and_file(tmp_path)
+
+    # run from a copy of the script dir, so extraction starts from scratch
+    script_dir = tmp_path / "script"
+    (script_dir / "adb").mkdir(parents=True)
+    archive = Path(__file__).parents[2] / "adb" / "platform-tools-latest-linux.zip"
+    (script_dir / "adb" / archive.name).write_bytes(archive.read_bytes())
+    monkeypatch.setattr("flash_utils.flash.sys.platform", "linux")
+
+    sys.argv = [str(script_dir / "flash_util.py"), "--rootfs", "--image_path", str(image_dir)]
+
+    mock_serial_port.device.load(rootfs_script(), output=AUTOBOOT_PROMPT)
+    FlashUtil()
+
+    extracted = sorted(
+        str(path.relative_to(script_dir / "adb")) for path in (script_dir / "adb").rglob("*.*")
+    )
+    fastboot = script_dir / "adb" / "platform-tools" / "fastboot"
+    assert fastboot.is_file()
+    assert fastboot.stat().st_mode & 0o777 == 0o755
+    assert extracted == ["platform-tools-latest-linux.zip", "platform-tools/lib64/libc++.so"]
+
+    mock_zipfile = Mock()
+    monkeypatch.setattr("flash_utils.flash.zipfile.ZipFile", mock_zipfile)
+    mock_serial_port.device.load(rootfs_script(), output=AUTOBOOT_PROMPT)
+    FlashUtil()
+
+    mock_zipfile.assert_not_called()
+
+    # a copy extracted without its executable bit is fixed up without re-extracting
+    fastboot.chmod(0o644)
+    mock_serial_port.device.load(rootfs_script(), output=AUTOBOOT_PROMPT)
+    FlashUtil()
+
+    mock_zipfile.assert_not_called()
+    assert fastboot.stat().st_mode & 0o777 == 0o755
+
+
+def test_extract_adb_error(
+    capsys: pytest.CaptureFixture[str], tmp_path, mock_serial_port, mock_popen
+):
+    """Test a failed fastboot extraction on its background thread still stops the flash"""
+
+    image_dir, _ = setup_tmp_rootfs_dir_and_file(tmp_path)
+
+    # a script dir without the platform tools archives
+    script_dir = tmp_path / "script"
+    script_dir.mkdir()
+
+    sys.argv = [str(script_dir / "flash_util.py"), "--rootfs", "--image_path", str(image_dir)]
+    mock_serial_port.device.load(rootfs_script(), output=AUTOBOOT_PROMPT)
+    with pytest.raises(SystemExit):
+        FlashUtil()
+
+    output = capsys.readouterr()
+    assert "can't find adb" in output.err.lower()
+    mock_popen.assert_not_called()
+
+
+def test_serial_write_timeout(capsys: pytest.CaptureFixture[str], tmp_path, mock_serial_port):
+    """Test a serial port that stops accepting data ends the flash with an error"""
+
+    image_dir, _, _, _ = setup_tmp_bootloader_dir_and_files(tmp_path)
+    mock_serial_port.device.load([], output=b"please send !")
+    mock_serial_port.return_value.write.side_effect = serial.SerialTimeoutException("Write timeout")
+
+    sys.argv = ["flash_util.py", "--bootloader", "--image_path", str(image_dir)]
+    with pytest.raises(SystemExit):
+        FlashUtil()
+
+    output = capsys.readouterr()
+    assert "timed out writing to serial port" in output.err.lower()
+
+
+def test_serial_read_disconnect(capsys: pytest.CaptureFixture[str], tmp_path, mock_serial_port):
+    """Test a serial port that disappears while waiting for a prompt ends with an error"""
+
+    image_dir, _, _, _ = setup_tmp_bootloader_dir_and_files(tmp_path)
+    mock_serial_port.return_value.read.side_effect = serial.SerialException(
+        "device reports readiness to read but returned no data"
+    )
+
+    sys.argv = ["flash_util.py", "--bootloader", "--image_path", str(image_dir)]
+    with pytest.raises(SystemExit):
+        FlashUtil()
+
+    output = capsys.readouterr()
+    assert "lost serial port while waiting for 'please send !'" in output.err.lower()
+
+
+def test_rootfs_write_static_ip(tmp_path, mock_serial_port, mock_popen):
+    """Test FlashUtil writing rootfs with --static_ip, waiting on U-Boot's prompt throughout"""
+
+    image_dir, _ = setup_tmp_rootfs_dir_and_file(tmp_path)
+
+    steps = rootfs_script()
+    steps[1] = (b"\rsetenv ipaddr " + DEVICE_IP_ADDRESS.encode() + b"\r", b"\r\n=> ")
+    mock_serial_port.device.load(steps, output=AUTOBOOT_PROMPT)
+
+    sys.argv = ["flash_util.py", "--rootfs", "--static_ip", DEVICE_IP_ADDRESS]
+    sys.argv += ["--image_path", str(image_dir)]
+    FlashUtil()
+
+    assert not mock_serial_port.device.script
+    assert f"udp:{DEVICE_IP_ADDRESS}" in mock_popen.call_args.args[0]
+
+
+def test_rootfs_write_fastboot_usb(tmp_path, mock_serial_port, mock_popen):
+    """Test FlashUtil writing rootfs with --fastboot_usb skips networking and the -s target"""
+
+    image_dir, rootfs_file = setup_tmp_rootfs_dir_and_file(tmp_path)
+
+    steps = [(b"y\r", b"\r\n=> "), (b"\rfastboot usb 0\r", b"")]
+    mock_serial_port.device.load(steps, output=AUTOBOOT_PROMPT)
+
+    sys.argv = ["flash_util.py", "--rootfs", "--fastboot_usb", "--image_path", str(image_dir)]
+    FlashUtil()
+
+    assert not mock_serial_port.device.script
+    fastboot_argv = mock_popen.call_args.args[0]
+    assert "-s" not in fastboot_argv
+    assert fastboot_argv[1:] == ["-v", "flash", "rawimg", str(rootfs_file)]
+
+
+@pytest.mark.parametrize("platform", ("win32", "linux"))
+def test_serial_buffer_size(tmp_path, mock_serial_port, monkeypatch, platform):
+    """Test the driver queues are sized for a whole image block on Windows only"""
+
+    image_dir, flash_writer_image, bl2_image, fip_image = setup_tmp_bootloader_dir_and_files(
+        tmp_path
+    )
+    mock_serial_port.device.load(
+        emmc_bootloader_script(flash_writer_image, bl2_image, fip_image), output=b"please send !"
     )
+    monkeypatch.setattr("flash_utils.flash.sys.platform", platform)
+
+    sys.argv = ["flash_util.py", "--bootloader", "--image_path", str(image_dir)]
+    FlashUtil()
+
+    set_buffer_size = mock_serial_port.return_value.set_buffer_size
+    if platform == "win32":
+        set_buffer_size.assert_called_once_with(
+            rx_size=SERIAL_CHUNK_SIZE, tx_size=SERIAL_CHUNK_SIZE
+        )
+    else:
+        set_buffer_size.assert_not_called()
+
+
+@pytest.mark.parametrize("error", (None, ValueError("Failed to update ASYNC_LOW_LATENCY flag")))
+def test_serial_low_latency_mode(tmp_path, mock_serial_port, monkeypatch, error):
+    """Test low latency mode is requested on Linux, and drivers without it still flash"""
+
+    image_dir, flash_writer_image, bl2_image, fip_image = setup_tmp_bootloader_dir_and_files(
+        tmp_path
+    )
+    mock_serial_port.device.load(
+        emmc_bootloader_script(flash_writer_image, bl2_image, fip_image), output=b"please send !"
+    )
+    monkeypatch.setattr("flash_utils.flash.sys.platform", "linux")
+    set_low_latency_mode = mock_serial_port.return_value.set_low_latency_mode
+    set_low_latency_mode.side_effect = error
+
+    sys.argv = ["flash_util.py", "--bootloader", "--image_path", str(image_dir)]
+    FlashUtil()
+
+    set_low_latency_mode.assert_called_once_with(True)
+    assert not mock_serial_port.device.script